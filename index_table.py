@@ -1,9 +1,19 @@
 from tinydb.table import Table, Document
 from tinydb.storages import Storage
+from tinydb.middlewares import Middleware
 from tinydb.queries import Query
+from tinydb.utils import freeze
 # from sortedcollection import SortedCollection
 from sortedcontainers import SortedKeyList
 
+from collections import deque
+from copy import deepcopy
+from functools import wraps
+from inspect import signature
+from time import perf_counter
+import hashlib
+import logging
+
 from typing import (
     Callable,
     Dict,
@@ -12,13 +22,94 @@ from typing import (
     List,
     Mapping,
     Optional,
+    Tuple,
     Union,
     cast
 )
 
+logger = logging.getLogger(__name__)
+
+def _query_digest(cond) -> Optional[str]:
+    """
+    A digest of a query's ``_hash`` that stays the same across processes,
+    unlike ``hash()``. Returns ``None`` for queries without a hash.
+    """
+    def canonical(value) -> str:
+        # Sets and dicts are sorted, as their order depends on the process
+        if isinstance(value, frozenset):
+            return '{' + ', '.join(sorted(canonical(v) for v in value)) + '}'
+        if isinstance(value, dict):
+            return '{' + ', '.join(sorted(
+                canonical(k) + ': ' + canonical(v) for k, v in value.items())) + '}'
+        if isinstance(value, tuple):
+            items = [canonical(v) for v in value]
+            return '(' + ', '.join(items) + (',' if len(items) == 1 else '') + ')'
+        if callable(value):
+            return getattr(value, '__module__', '') + '.' + getattr(value, '__qualname__', '')
+        return repr(value)
+
+    path = getattr(cond, '_hash', None)
+    if path is None:
+        return None
+    
+    return hashlib.sha1(canonical(path).encode()).hexdigest()
+
+def _profiled(operation: str, returned: Optional[Callable] = len):
+    """
+    Report calls of an ``IndexableTable`` method to the table's profile hooks
+    and slow-query log. ``returned`` turns the method's result into the
+    number of documents returned. Calls run unchanged while profiling is off.
+    """
+    def decorator(func):
+        func_signature = signature(func)
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self._profile_hooks and self.slow_query_threshold is None:
+                return func(self, *args, **kwargs)
+
+            cond = func_signature.bind(self, *args, **kwargs).arguments.get('cond')
+            record = {
+                'operation': operation,
+                'query': cond,
+                'query_hash': _query_digest(cond),
+                'plan': None,
+                'examined': None,
+                'returned': None,
+                'read_bytes': None,
+                'write_bytes': None,
+                'read_time': 0.0,
+                'write_time': 0.0,
+                'duration': None,
+            }
+
+            self._profile_stack.append(record)
+            start = perf_counter()
+            try:
+                result = func(self, *args, **kwargs)
+            finally:
+                self._profile_stack.pop()
+
+            record['duration'] = perf_counter() - start
+            if returned is not None:
+                record['returned'] = returned(result)
+            self._profile_report(record)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
 class IndexableTable(Table):
     
     default_index_fields = []
+    unique_index_fields = []
+    
+    #: Operations taking at least this many seconds are kept in
+    #: ``slow_query_log``. ``None`` disables the log.
+    slow_query_threshold = None
+    slow_query_log_size = 100
     
     def __init__(
         self,
@@ -29,73 +120,83 @@ class IndexableTable(Table):
     ):
 #       print(self.default_index_fields)
 #       print(index_fields)
+        #Create Profiling State
+        # Has to exist before the first storage read below
+        self._profile_hooks = []
+        self._profile_stack = []
+        self.slow_query_log = deque(maxlen=self.slow_query_log_size)
+        
         super().__init__(storage, name, cache_size)
         
+        #Create Document Store
+        # Every document is held exactly once, keyed by its ID. The indexes
+        # share these objects and the query cache only stores document IDs,
+        # callers get copies (see ``_read_documents``).
+        self._documents = {}
+        
         #Create Indexes
         self._index_table = {}
         if not (self.default_index_fields is None):
             for field in self.default_index_fields:
-                self._index_table[field] = SortedKeyList(self, lambda x: x[field])
+                self._index_table[field] = SortedKeyList(key=lambda x, field=field: x[field])
+        
+        #Create Unique Indexes
+        self._unique_index = {}
+        if not (self.unique_index_fields is None):
+            for field in self.unique_index_fields:
+                self._unique_index[field] = {}
+        
+        # Reading the table fills the store and the indexes
+        self._read_table()
     
+    @_profiled('insert', returned=lambda doc_id: 1)
     def insert(self, document: Mapping) -> int:
-        doc_id = super().insert(document)
+        #Enforce unique indexes
+        self._check_unique(None, document)
         
-        #Update Query Cache
-        for query in self._query_cache.lru:
-            results = self._query_cache[query]
-            if query(document) and results is not None:
-                results.append(document)
-                
-        #Update Indexes
-        for _ , v in self._index_table.items():
-            v.add(document)
+        doc_id = super().insert(document)
+        self._add_document(doc_id, self._stored_table[str(doc_id)])
                 
         return doc_id
     
+    @_profiled('insert_multiple')
     def insert_multiple(self, documents: Iterable[Mapping]) -> List[int]:
-        doc_ids = super().insert_multiple(documents)
+        # The documents are iterated more than once below, so make sure a
+        # generator isn't exhausted by the first pass
+        documents = list(documents)
         
-        #Update Query Cache
-        for query in self._query_cache.lru:
-            results = self._query_cache[query]
-            if results is not None:
-                for doc in documents:
-                    if query(doc):
-                        results.append(doc)
-                
-        #Update Indexes
-        for _ , v in self._index_table.items():
-            for doc_id in doc_ids:
-                v.add(self.get(doc_id=doc_id))
+        #Enforce unique indexes
+        claimed = {}
+        for doc in documents:
+            self._check_unique(None, doc, claimed)
+        
+        doc_ids = super().insert_multiple(documents)
+        for doc_id in doc_ids:
+            self._add_document(doc_id, self._stored_table[str(doc_id)])
                 
         return doc_ids
     
+    @_profiled('search')
     def search(self, cond: Query) -> List[Document]:
-        if not cond in self._query_cache:
-            a = self.get_index_query(cond, list(self._index_table))        
-            if a != None:
-                index_func = a[0]
-                docs = index_func(self._index_table.get(a[1]))
-                self._query_cache[cond] = docs[:]
-            else:
-                docs = super().search(cond)                 
-        else:
-            docs = super().search(cond)
-
-        return docs       
+        return self._read_documents(self._search_ids(cond))
         
+    @_profiled('get', returned=lambda doc: int(doc is not None))
     def get(
         self,
         cond: Optional[Query] = None,
         doc_id: Optional[int] = None,
     ) -> Optional[Document]:
         
-        #Check Query Cache
         if (doc_id is None) and (cond is not None):
-            if cond in self._query_cache:
-                for doc in self._query_cache.get(cond):
-                    if cond(doc):
-                        return doc        
+            #Check Query Cache
+            doc_ids = self._query_cache.get(cond)
+            if doc_ids is not None:
+                doc_id = next(iter(doc_ids), None)
+                if doc_id is None:
+                    self._profile_note(plan='cache', examined=0)
+                    return None
+                self._profile_note(plan='cache', examined=1)
+                return self._read_documents([doc_id])[0]
             #Check indexes
 #             a = self.get_index_query(cond, list(self._index_table))        
 #             if a != None:
@@ -104,9 +205,26 @@ class IndexableTable(Table):
 #                 self._query_cache[cond] = docs[:]
 #                 print(len(docs))
 #                 return docs[0]
+            
+            # Scan the document store up to the first match
+            examined = 0
+            for doc_id, doc in self._documents.items():
+                examined += 1
+                if cond(doc):
+                    self._profile_note(plan='scan', examined=examined)
+                    return self._read_documents([doc_id])[0]
+            
+            self._profile_note(plan='scan', examined=examined)
+            return None
         
+        self._profile_note(plan='id', examined=1)
         return super().get(cond, doc_id)
+    
+    @_profiled('count', returned=lambda count: count)
+    def count(self, cond: Query) -> int:
+        return len(self._search_ids(cond))
            
+    @_profiled('update')
     def update(
         self,
         fields: Union[Mapping, Callable[[Mapping], None]],
@@ -115,44 +233,85 @@ class IndexableTable(Table):
     ) -> List[int]:
         
         if callable(fields):
-            def perform_update(doc):
+            def perform_update(doc_id, doc):
                 # Update documents by calling the update function provided by
                 # the user
                 fields(doc)
         else:
-            def perform_update(doc):
+            def perform_update(doc_id, doc):
                 # Update documents by setting all fields from the provided data
                 doc.update(fields)
                 
-        def perform_update_override(doc):
-            old_value = doc.copy()
-            
-            #Remove from indexes
-            for _ , v in self._index_table.items():
-                v.remove(old_value)
-            
-            # Update element
-            perform_update(doc)
-            new_value = doc
-                
-            #Update Query Cache
-            for query in self._query_cache.lru:   
-                results = self._query_cache[query]
-
-                if query(old_value):
-                    # Remove old value from cache
-                    results.remove(old_value)
-
-                if query(new_value):
-                    # Add new value to cache
-                    results.append(new_value)
-                    
-            #Update indexes
-            for _ , v in self._index_table.items():
-                v.add(new_value)
+        #Find documents to update
+        if doc_ids is not None:
+            # Repeated IDs refer to the same document, so only update it once
+            updated_ids = [
+                doc_id for doc_id in dict.fromkeys(doc_ids)
+                if doc_id in self._documents
+            ]
+            self._profile_note(plan='id', examined=len(updated_ids))
+        elif cond is not None:
+            updated_ids = list(self._search_ids(cond))
+        else:
+            updated_ids = list(self._documents)
+            self._profile_note(plan='scan', examined=len(updated_ids))
+        
+        self._update_documents(updated_ids, perform_update, deep=callable(fields))
+        
+        return updated_ids
+    
+    @_profiled('update_multiple')
+    def update_multiple(
+        self,
+        updates: Iterable[
+            Tuple[Union[Mapping, Callable[[Mapping], None]], Query]
+        ],
+    ) -> List[int]:
+        updates = list(updates)
+        
+        # A document is only changed by a later update if an earlier one
+        # matched it, so only documents matching any query are affected
+        updated_ids = [
+            doc_id for doc_id, doc in self._documents.items()
+            if any(cond(doc) for _, cond in updates)
+        ]
+        self._profile_note(plan='scan', examined=len(self._documents))
+        
+        # ``Table.update_multiple`` reports a document once per update
+        # applied to it
+        matched_ids = []
+        
+        def perform_update(doc_id, doc):
+            for fields, cond in updates:
+                if cond(doc):
+                    matched_ids.append(doc_id)
+                    if callable(fields):
+                        fields(doc)
+                    else:
+                        doc.update(fields)
+        
+        self._update_documents(
+            updated_ids, perform_update,
+            deep=any(callable(fields) for fields, _ in updates),
+        )
         
-        return super().update(perform_update_override, cond, doc_ids)
+        return matched_ids
     
+    def upsert(self, document: Mapping, cond: Optional[Query] = None) -> List[int]:
+        # Look up the existing document in a unique index, if the query or
+        # the document itself names a uniquely indexed key
+        lookup = self.get_unique_query(document, cond)
+        if lookup is None:
+            return super().upsert(document, cond)
+        
+        field, key = lookup
+        doc_id = self._unique_index[field].get(key)
+        if doc_id is not None:
+            return self.update(document, doc_ids=[doc_id])
+        
+        return [self.insert(document)]
+    
+    @_profiled('remove')
     def remove(
         self,
         cond: Optional[Query] = None,
@@ -162,37 +321,190 @@ class IndexableTable(Table):
         if cond is None and doc_ids is None:
             raise RuntimeError('Use truncate() to remove all documents')
         
-        #Remove From Query Cache
-        docs_by_id = []
-        if not doc_ids is None:
-            docs_by_id = [self.get(doc_id=x) for x in doc_ids]
-            
-        for query in self._query_cache.lru:
-            if (not cond is None) and (query == cond):
-                del self._query_cache[query]
-            else:
-                for doc in self._query_cache[query]:
-                    if ( ((not cond is None) and (cond(doc))) or
-                         ((not doc_ids is None) and doc in docs_by_id) ):
-                        self._query_cache[query].remove(doc)
-                        
-        #Remove from index
-        for _ , v in self._index_table.items():
-            for document in docs_by_id:
-                v.remove(document)
-            if (not cond is None): 
-                for document in v.copy():
-                    if cond(document):
-                        v.remove(document)
-        
-        return super().remove(cond, doc_ids)
+        if doc_ids is not None:
+            doc_ids = list(doc_ids)
+            self._profile_note(plan='id', examined=len(doc_ids))
+        else:
+            self._profile_note(plan='scan', examined=len(self._documents))
+        
+        removed_ids = super().remove(cond, doc_ids)
+        
+        #Remove from indexes and query cache
+        for doc_id in removed_ids:
+            self._remove_document(doc_id)
+        
+        return removed_ids
     
     def truncate(self) -> None:
         super().truncate()
         self.clear_cache()
+        self._documents.clear()
         for _ , v in self._index_table.items():
             v.clear()
+        for _ , v in self._unique_index.items():
+            v.clear()
+    
+    def _search_ids(self, cond: Query) -> Dict[int, None]:
+        """
+        Get the IDs of all documents matching ``cond``, from the query cache
+        if possible, otherwise from an index, by filtering cached range
+        queries that cover ``cond`` or by scanning the document store.
+        Cached ranges are only used for fields without an index, as an
+        index lookup is always at least as cheap.
+
+        The IDs are the keys of an insertion ordered dict, which is what the
+        query cache stores so that updates can check and change membership
+        in constant time.
+        """
+        doc_ids = self._query_cache.get(cond)
+        if doc_ids is not None:
+            self._profile_note(plan='cache', examined=len(doc_ids))
+            return doc_ids
+        
+        a = self.get_index_query(cond, list(self._index_table))        
+        if a != None:
+            index_func = a[0]
+            doc_ids = dict.fromkeys(doc.doc_id for doc in index_func(self._index_table.get(a[1])))
+            self._profile_note(plan='index', examined=len(doc_ids))
+        else:
+            covering = self.get_covering_queries(cond)
+            if covering is not None:
+                # Filter the cached results of the range queries covering cond
+                candidates = dict.fromkeys(
+                    doc_id for query in covering
+                    for doc_id in self._query_cache[query]
+                )
+                doc_ids = dict.fromkeys(
+                    doc_id for doc_id in candidates
+                    if cond(self._documents[doc_id])
+                )
+                self._profile_note(plan='subsume', examined=len(candidates))
+            else:
+                doc_ids = dict.fromkeys(
+                    doc_id for doc_id, doc in self._documents.items()
+                    if cond(doc)
+                )
+                self._profile_note(plan='scan', examined=len(self._documents))
+        
+        # Only cache cacheable queries, see ``Table.search``
+        is_cacheable = getattr(cond, 'is_cacheable', lambda: True)
+        if is_cacheable():
+            self._query_cache[cond] = doc_ids
+        
+        return doc_ids
+    
+    def _update_documents(
+        self,
+        updated_ids: List[int],
+        perform_update: Callable[[int, Mapping], None],
+        deep: bool = True,
+    ):
+        """
+        Apply ``perform_update`` to copies of the given documents, check the
+        whole batch against the unique indexes and only then write the new
+        values to the storage, the document store, the indexes and the query
+        cache. Pass ``deep=False`` if ``perform_update`` only sets top level
+        fields, so the copies don't have to be deep.
+        """
+        claimed = {}
+        changes = []
+        for doc_id in updated_ids:
+            old_value = self._documents[doc_id]
+            new_value = deepcopy(dict(old_value)) if deep else dict(old_value)
+            perform_update(doc_id, new_value)
+            
+            #Enforce unique indexes
+            self._check_unique(old_value, new_value, claimed)
+            changes.append(new_value)
+        
+        def updater(table: dict):
+            for doc_id, new_value in zip(updated_ids, changes):
+                table[doc_id] = new_value
+        
+        self._update_table(updater)
     
+        for doc_id in updated_ids:
+            old_doc = self._documents[doc_id]
+            new_doc = self.document_class(self._stored_table[str(doc_id)], doc_id)
+            self._documents[doc_id] = new_doc
+        
+            #Update unique indexes
+            self._remove_unique(old_doc)
+            self._add_unique(doc_id, new_doc)
+            
+            #Update Query Cache
+            for query in self._query_cache.lru:   
+                results = self._query_cache[query]
+            
+                if doc_id in results:
+                    if not query(new_doc):
+                        # Remove old value from cache
+                        del results[doc_id]
+                elif query(new_doc):
+                    # Add new value to cache
+                    results[doc_id] = None
+                
+            #Update indexes
+            for _ , v in self._index_table.items():
+                self._index_discard(v, old_doc)
+                v.add(new_doc)
+    
+    def _read_documents(self, doc_ids: Iterable[int]) -> List[Document]:
+        """
+        Resolve document IDs against the document store. Like ``Table``, every
+        call returns shallow copies: setting or deleting a field of a result
+        leaves the shared documents alone, but nested lists and dicts are
+        shared with the store and must not be modified in place.
+        """
+        return [
+            self.document_class(self._documents[doc_id], doc_id)
+            for doc_id in doc_ids
+        ]
+    
+    def _add_document(self, doc_id: int, document: Mapping):
+        """
+        Add a newly written document to the document store, the indexes and
+        the matching query cache entries.
+        """
+        doc = self.document_class(document, doc_id)
+        self._documents[doc_id] = doc
+        self._add_unique(doc_id, doc)
+        
+        #Update Query Cache
+        for query in self._query_cache.lru:
+            if query(doc):
+                self._query_cache[query][doc_id] = None
+        
+        #Update Indexes
+        for _ , v in self._index_table.items():
+            v.add(doc)
+    
+    def _remove_document(self, doc_id: int):
+        """
+        Remove a document from the document store, the indexes and the query
+        cache.
+        """
+        doc = self._documents.pop(doc_id)
+        self._remove_unique(doc)
+        
+        #Remove From Query Cache
+        for query in self._query_cache.lru:
+            self._query_cache[query].pop(doc_id, None)
+        
+        #Remove from indexes
+        for _ , v in self._index_table.items():
+            self._index_discard(v, doc)
+    
+    def _index_discard(self, index: SortedKeyList, doc: Document):
+        # The index may hold several equal documents, so only drop the entry
+        # that is this very document
+        key = index.key(doc)
+        for i in range(index.bisect_key_left(key), index.bisect_key_right(key)):
+            if index[i] is doc:
+                del index[i]
+                return
+    
+    @_profiled('_update_table', returned=None)
     def _update_table(self, updater: Callable[[Dict[int, Mapping]], None]):
         """
         Perform an table update operation.
@@ -205,7 +517,7 @@ class IndexableTable(Table):
         document class, as the table data will *not* be returned to the user.
         """
 
-        tables = self._storage.read()
+        tables = self._read_storage()
 
         if tables is None:
             # The database is empty
@@ -238,55 +550,366 @@ class IndexableTable(Table):
         }
 
         # Write the newly updated data back to the storage
-        self._storage.write(tables)
+        self._write_storage(tables)
+        
+        # Read back what the storage actually holds, as serializing may have
+        # changed the documents (e.g. tuples become lists in JSON). The
+        # document store is updated from this.
+        tables = self._read_storage()
+        self._stored_table = {} if tables is None else tables.get(self.name, {})
         
         # Clear the query cache, as the table contents have changed
 #         self.clear_cache()
 
-    def get_index_query(self, cond: Query, index_keys: list):
-        path = cond._hash
+    def _read_table(self) -> Dict[str, Mapping]:
+        start = perf_counter()
+        table = super()._read_table()
+        self._profile_io('read', start)
+        self._sync_documents(table)
+        
+        return table
+    
+    def _sync_documents(self, table: Mapping):
+        """
+        Rebuild the document store, the indexes and the query cache if the
+        table read from the storage differs from the document store, e.g.
+        because another ``TinyDB`` instance wrote to the same file.
 
-        def process_tuple(path: tuple, index_keys: list):
-            op = path[0]
-            key = path[1]
+        Searches and counts are answered from the document store, so they
+        only see such outside changes once the table has been read again
+        (by ``len``, ``all``, ``get`` by ID or any write).
+        """
+        if len(table) == len(self._documents) and all(
+            self._documents.get(self.document_id_class(doc_id)) == doc
+            for doc_id, doc in table.items()
+        ):
+            return
+        
+        self.clear_cache()
+        self._documents = {}
+        for doc_id, doc in table.items():
+            doc_id = self.document_id_class(doc_id)
+            self._documents[doc_id] = self.document_class(doc, doc_id)
+        
+        for _ , v in self._index_table.items():
+            v.clear()
+            v.update(self._documents.values())
+        
+        for _ , v in self._unique_index.items():
+            v.clear()
+        for doc in self._documents.values():
+            self._check_unique(None, doc)
+            self._add_unique(doc.doc_id, doc)
+    
+    def _read_storage(self):
+        start = perf_counter()
+        tables = self._storage.read()
+        self._profile_io('read', start)
+        
+        return tables
+    
+    def _write_storage(self, tables: Dict):
+        start = perf_counter()
+        self._storage.write(tables)
+        self._profile_io('write', start)
+    
+    def add_profile_hook(self, hook: Callable[[Dict], None]):
+        """
+        Register a function to be called after every profiled operation.
 
-            if op == 'not':
-                return process_tuple(key, index_keys)
+        The hook receives a dict describing the operation:
 
-            if not op in ['==', '<', '>', '<=', '>=', '!=']:
+        - ``operation``: ``search``, ``get``, ``count``, ``insert``,
+          ``insert_multiple``, ``update``, ``update_multiple``, ``remove`` or
+          ``_update_table``
+        - ``query`` and ``query_hash``: the query and a hex digest of it that
+          is stable across processes, so records can be grouped by query.
+          Either is ``None`` if there is no query, ``query_hash`` also for
+          queries that can't be hashed (e.g. plain functions)
+        - ``plan``: how the documents were found, one of ``cache``,
+          ``subsume`` (filtered from a covering cached range query),
+          ``index``, ``scan`` or ``id``
+        - ``examined`` and ``returned``: documents looked at and returned
+          (or written), ``None`` where unknown
+        - ``read_bytes``, ``write_bytes``, ``read_time`` and ``write_time``:
+          storage traffic. The byte counts are only known for storages with
+          a file handle, such as ``JSONStorage``. They are ``None`` for other
+          storages and for storages wrapped in a middleware (e.g.
+          ``CachingMiddleware``), which may not touch the file at all
+        - ``duration``: wall time of the whole operation in seconds
+
+        Operations that run inside another one (e.g. ``_update_table``
+        during an ``insert``) are reported separately, and their storage
+        traffic is added to the enclosing operation as well. Operations
+        that raise are not reported, and exceptions raised by a hook are
+        logged instead of being passed on.
+        """
+        self._profile_hooks.append(hook)
+    
+    def remove_profile_hook(self, hook: Callable[[Dict], None]):
+        self._profile_hooks.remove(hook)
+    
+    def _profile_report(self, record: Dict):
+        if self._profile_stack:
+            # Account the storage traffic to the enclosing operation
+            parent = self._profile_stack[-1]
+            for kind in ('read', 'write'):
+                parent[kind + '_time'] += record[kind + '_time']
+                if record[kind + '_bytes'] is not None:
+                    parent[kind + '_bytes'] = (parent[kind + '_bytes'] or 0) + record[kind + '_bytes']
+        elif (self.slow_query_threshold is not None and
+              record['duration'] >= self.slow_query_threshold):
+            self.slow_query_log.append(record)
+        
+        for hook in self._profile_hooks:
+            try:
+                hook(record)
+            except Exception:
+                # A broken hook mustn't fail an operation that succeeded
+                logger.exception('Profile hook %r failed', hook)
+    
+    def _profile_note(self, **fields):
+        # Add details to the innermost running operation
+        if self._profile_stack:
+            self._profile_stack[-1].update(fields)
+    
+    def _profile_io(self, kind: str, start: float):
+        if not self._profile_stack:
+            return
+        
+        record = self._profile_stack[-1]
+        record[kind + '_time'] += perf_counter() - start
+        
+        # Middlewares forward attribute lookups to the storage they wrap,
+        # but may answer from memory without touching it
+        if isinstance(self._storage, Middleware):
+            return
+        
+        # File based storages leave their handle at the end of what they
+        # just read or wrote
+        handle = getattr(self._storage, '_handle', None)
+        if handle is not None:
+            record[kind + '_bytes'] = (record[kind + '_bytes'] or 0) + handle.tell()
+
+    def _check_unique(
+        self,
+        old_value: Optional[Mapping],
+        new_value: Mapping,
+        claimed: Optional[Dict] = None,
+    ):
+        """
+        Raise a ``ValueError`` if ``new_value`` would duplicate a key in one
+        of the unique indexes. ``old_value`` is the document's current value
+        (``None`` for new documents) and ``claimed`` collects the keys taken
+        by earlier documents of the same insert/update operation.
+        """
+        if claimed is None:
+            claimed = {}
+        
+        for field, index in self._unique_index.items():
+            if not field in new_value:
+                continue
+            
+            # Freeze the key, so lists and dicts can be used as keys as well
+            key = freeze(new_value[field])
+            if (old_value is not None) and (field in old_value) and (freeze(old_value[field]) == key):
+                continue
+            
+            taken = claimed.setdefault(field, set())
+            if key in index or key in taken:
+                raise ValueError(f'Document with {field} {key!r} '
+                                 f'already exists')
+            taken.add(key)
+    
+    def _add_unique(self, doc_id: int, document: Mapping):
+        for field, index in self._unique_index.items():
+            if field in document:
+                index[freeze(document[field])] = doc_id
+    
+    def _remove_unique(self, document: Mapping):
+        for field, index in self._unique_index.items():
+            if field in document:
+                index.pop(freeze(document[field]), None)
+
+    def get_unique_query(self, document: Mapping, cond: Optional[Query]):
+        """
+        Find the unique index that can locate the target of an upsert.
+        Returns a ``(field, key)`` tuple or ``None`` if the upsert has to
+        fall back to searching the table.
+        """
+        if isinstance(document, self.document_class) and hasattr(document, 'doc_id'):
+            # Upserts by document ID don't need an index
+            return None
+        
+        if cond is None:
+            for field in self._unique_index:
+                if field in document:
+                    return (field, freeze(document[field]))
+            return None
+        
+        path = getattr(cond, '_hash', None)
+        if not (isinstance(path, tuple) and len(path) == 3 and path[0] == '=='):
+            return None
+        
+        key = path[1]
+        if not (len(key) == 1 and key[0] in self._unique_index):
+            return None
+        
+        return (key[0], path[2])
+
+    def get_range_query(self, cond: Query):
+        """
+        Describe a comparison query (``==``, ``<``, ``<=``, ``>``, ``>=`` or
+        an ``&`` of those on the same field) as the interval of values it
+        matches. Returns a ``(key, lo, lo_inclusive, hi, hi_inclusive)``
+        tuple, where ``key`` is the field path and ``None`` bounds are
+        unbounded, or ``None`` if the query isn't a plain range.
+        """
+        def process_tuple(path: tuple):
+            if not isinstance(path, tuple) or len(path) < 2:
                 return None
 
-            key = key[0]
-            if not key in index_keys:
+            op = path[0]
+
+            if op == 'and':
+                ranges = [process_tuple(p) for p in path[1]]
+                if not ranges or None in ranges:
+                    return None
+                
+                key, lo, lo_inc, hi, hi_inc = ranges[0]
+                for r_key, r_lo, r_lo_inc, r_hi, r_hi_inc in ranges[1:]:
+                    if r_key != key:
+                        return None
+                    if r_lo is not None and (lo is None or r_lo > lo or (r_lo == lo and not r_lo_inc)):
+                        lo, lo_inc = r_lo, r_lo_inc
+                    if r_hi is not None and (hi is None or r_hi < hi or (r_hi == hi and not r_hi_inc)):
+                        hi, hi_inc = r_hi, r_hi_inc
+                return (key, lo, lo_inc, hi, hi_inc)
+
+            if len(path) != 3:
                 return None
 
+            key = path[1]
             val = path[2]
-            print(op)
-            print(key)
-            print(val)
+            if val is None:
+                return None
             if op == '==':
-                def get_items(index):
-                    print(index)
-                    return [i for i in index.irange_key(val, val)]
+                return (key, val, True, val, True)
             elif op == '<':
-                def get_items(index):
-                    return [i for i in index.irange_key(None, val, False)]
-            elif op == '!=':
-                def get_items(index):
-                    return [i for i in index.irange_key(None, val, False)] + [i for i in index.irange_key(val, None, False)]
-            elif op == '>':
-                def get_items(index):
-                    return [i for i in index.irange_key(val, None, False)]
+                return (key, None, False, val, False)
             elif op == '<=':
-                def get_items(index):
-                    return [i for i in index.irange_key(None, val, True)]
+                return (key, None, False, val, True)
+            elif op == '>':
+                return (key, val, False, None, False)
             elif op == '>=':
-                def get_items(index):
-                    return [i for i in index.irange_key(val, None, True)]
-            else:
+                return (key, val, True, None, False)
+
+            return None
+
+        try:
+            return process_tuple(getattr(cond, '_hash', None))
+        except TypeError:
+            # The bounds can't be compared with each other
+            return None
+
+    def get_covering_queries(self, cond: Query) -> Optional[List[Query]]:
+        """
+        Find cached range queries whose results, taken together, include
+        every document matching the range query ``cond``. Returns ``None``
+        if the cache doesn't cover ``cond``.
+
+        Merging intervals relies on the bounds being totally ordered, so only
+        ranges over numbers or strings are considered. ``_search_ids`` only
+        asks for covering queries on fields without an index.
+        """
+        def is_ordered(r):
+            return all(
+                v is None or isinstance(v, str) or (
+                    isinstance(v, (int, float)) and v == v)
+                for v in (r[1], r[3])
+            )
+
+        target = self.get_range_query(cond)
+        if target is None or not is_ordered(target):
+            return None
+        key, lo, lo_inc, hi, hi_inc = target
+
+        candidates = []
+        for query in self._query_cache.lru:
+            r = self.get_range_query(query)
+            if r is not None and r[0] == key and is_ordered(r):
+                candidates.append((query, r))
+
+        def starts_before(r_lo, r_lo_inc, lo, lo_inc):
+            if r_lo is None:
+                return True
+            if lo is None:
+                return False
+            return r_lo < lo or (r_lo == lo and (r_lo_inc or not lo_inc))
+
+        def ends_after(r_hi, r_hi_inc, hi, hi_inc):
+            if r_hi is None:
+                return True
+            if hi is None:
+                return False
+            return r_hi > hi or (r_hi == hi and (r_hi_inc or not hi_inc))
+
+        # Sweep from the lower bound of ``cond`` upwards, each time picking
+        # the cached interval that reaches furthest past the point covered
+        # so far, until the upper bound of ``cond`` is reached
+        covering = []
+        try:
+            while candidates:
+                best = None
+                for query, (_, r_lo, r_lo_inc, r_hi, r_hi_inc) in candidates:
+                    if not starts_before(r_lo, r_lo_inc, lo, lo_inc):
+                        continue
+                    if lo is not None and not (r_hi is None or r_hi > lo or (
+                            r_hi == lo and r_hi_inc and lo_inc)):
+                        continue
+                    if best is None or ends_after(r_hi, r_hi_inc, best[1], best[2]):
+                        best = (query, r_hi, r_hi_inc)
+
+                if best is None:
+                    return None
+
+                query, r_hi, r_hi_inc = best
+                covering.append(query)
+                if ends_after(r_hi, r_hi_inc, hi, hi_inc):
+                    return covering
+
+                # Everything up to ``r_hi`` is covered now
+                lo, lo_inc = r_hi, not r_hi_inc
+                candidates = [c for c in candidates if c[0] is not query]
+        except TypeError:
+            # The cached bounds can't be compared with the ones of ``cond``
+            return None
+
+        return None
+
+    def get_index_query(self, cond: Query, index_keys: list):
+        path = getattr(cond, '_hash', None)
+
+        if isinstance(path, tuple) and path[0] == '!=':
+            key = path[1]
+            if not (len(key) == 1 and key[0] in index_keys):
                 return None
+            
+            val = path[2]
+            def get_items(index):
+                return [i for i in index.irange_key(None, val, (False, False))] + [i for i in index.irange_key(val, None, (False, False))]
+            
+            return (get_items, key[0])
 
-            return (get_items, key)
+        r = self.get_range_query(cond)
+        if r is None:
+            return None
+        
+        key, lo, lo_inc, hi, hi_inc = r
+        if not (len(key) == 1 and key[0] in index_keys):
+            return None
+        
+        def get_items(index):
+            return [i for i in index.irange_key(lo, hi, (lo_inc, hi_inc))]
 
-        return process_tuple(path, index_keys)
-        
\ No newline at end of file
+        return (get_items, key[0])
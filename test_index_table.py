@@ -1,7 +1,10 @@
 from tinydb import TinyDB, where
 from tinydb.database import Table
-from tinydb.storages import MemoryStorage
+from tinydb.storages import JSONStorage, MemoryStorage
+from tinydb.middlewares import CachingMiddleware
 # from tinydb.utils import catch_warning
+import hashlib
+
 import pytest
 
 from index_table import IndexableTable
@@ -36,6 +39,20 @@ def db_no_index():
     
     return table
 
+@pytest.fixture
+def db_unique():
+    TinyDB.table_class = IndexableTable
+    TinyDB.table_class.unique_index_fields = ['key']
+
+    db_ = TinyDB(storage=MemoryStorage)
+    table = db_.table('_default')
+
+    table.insert_multiple({'key': c, 'int': 1} for c in 'abc')
+
+    yield table
+
+    TinyDB.table_class.unique_index_fields = []
+
 @pytest.fixture
 def db():
     db_ = TinyDB(storage=MemoryStorage)
@@ -394,6 +411,77 @@ def test_search(db_index):
     assert len(db.search(where('int') == 1)) == 3  # Query result from cache
 
 
+def test_search_cache_ids(db_index):
+    db = db_index
+
+    query = where('int') == 1
+    other = where('char') == 'a'
+
+    assert len(db.search(query)) == 3
+    assert len(db.search(other)) == 1
+    assert list(db._query_cache[query]) == [1, 2, 3]
+    assert list(db._query_cache[other]) == [1]
+
+    # Results are copies of the shared documents
+    db.search(query)[0]['char'] = 'z'
+    assert db.search(other)[0]['char'] == 'a'
+
+    # Overlapping cached queries see the same update
+    db.update({'yar': 6}, doc_ids=[1])
+    assert db.search(query)[0]['yar'] == 6
+    assert db.search(other)[0]['yar'] == 6
+    assert db.get(other)['yar'] == 6
+
+
+def test_search_copies(db_index):
+    db = db_index
+
+    db.insert({'int': 2, 'tags': [1]})
+
+    query = where('int') == 2
+    db.search(query)[0]['tags'] = [2]
+    del db.get(query)['tags']
+
+    assert db.search(query)[0]['tags'] == [1]
+    assert db.get(doc_id=4)['tags'] == [1]
+
+
+def test_search_cache_hit_is_shallow(db_index):
+    db = db_index
+
+    db.truncate()
+    db.insert_multiple({'int': i, 'tags': [i]} for i in range(1000))
+
+    query = where('int') >= 0
+    first = db.search(query)
+    second = db.search(query)
+
+    # Cache hits copy the documents like ``Table`` does, without copying
+    # their nested values
+    assert first[0] is not second[0]
+    assert all(a['tags'] is b['tags'] for a, b in zip(first, second))
+
+
+def test_update_multiple(db_index):
+    db = db_index
+
+    assert db.count(where('char') == 'z') == 0
+
+    assert db.update_multiple([
+        ({'char': 'z'}, where('char') == 'a'),
+        ({'yar': 6}, where('char') == 'z'),
+        ({'int': 2}, where('char') == 'b'),
+    ]) == [1, 1, 2]
+
+    assert db.count(where('char') == 'z') == 1
+    assert db.search(where('yar') == 6) == [{'int': 1, 'yar': 6, 'char': 'z'}]
+    assert db.count(where('int') == 2) == 1
+    assert db.count(where('int') == 1) == 2
+    assert db.search(where('char') == 'z') == [
+        doc for doc in db.all() if doc['char'] == 'z'
+    ]
+
+
 def test_contians(db_index):
     db = db_index
 
@@ -442,4 +530,401 @@ def test_get_idempotent(db_index):
 
     u = db.get(where('int') == 1)
     z = db.get(where('int') == 1)
-    assert u == z
\ No newline at end of file
+    assert u == z
+
+def test_unique_insert(db_unique):
+    db = db_unique
+
+    assert db._unique_index['key'] == {'a': 1, 'b': 2, 'c': 3}
+
+    with pytest.raises(ValueError):
+        db.insert({'key': 'a', 'int': 1})
+    with pytest.raises(ValueError):
+        db.insert_multiple([{'key': 'd', 'int': 1}, {'key': 'd', 'int': 1}])
+
+    assert len(db) == 3
+
+    # Documents without the key aren't constrained
+    db.insert({'int': 2})
+    db.insert({'int': 3})
+    assert db.insert({'key': 'd', 'int': 4}) == 6
+    assert db._unique_index['key']['d'] == 6
+
+
+def test_unique_update(db_unique):
+    db = db_unique
+
+    with pytest.raises(ValueError):
+        db.update({'key': 'a'}, where('key') == 'b')
+    with pytest.raises(ValueError):
+        db.update({'key': 'd'})
+
+    # Updating a document to its own key is allowed
+    db.update({'key': 'a', 'int': 2}, where('key') == 'a')
+    db.update({'key': 'z'}, doc_ids=[2])
+
+    assert db._unique_index['key'] == {'a': 1, 'z': 2, 'c': 3}
+    assert db.get(doc_id=2)['key'] == 'z'
+
+    # Repeating an ID doesn't make the document clash with itself
+    assert db.update({'key': 'y'}, doc_ids=[1, 1]) == [1]
+    assert db._unique_index['key'] == {'y': 1, 'z': 2, 'c': 3}
+
+
+def test_unique_update_rollback(db_unique):
+    db = db_unique
+
+    # The second document violates the index, so none may change
+    with pytest.raises(ValueError):
+        db.update({'key': 'd'})
+
+    assert [doc['key'] for doc in db.all()] == ['a', 'b', 'c']
+    assert db._unique_index['key'] == {'a': 1, 'b': 2, 'c': 3}
+    with pytest.raises(ValueError):
+        db.insert({'key': 'a', 'int': 1})
+
+    db.insert({'key': 'd', 'int': 1})
+    assert db.count(where('key') == 'd') == 1
+
+
+def test_unique_unhashable(db_unique):
+    db = db_unique
+
+    db.insert({'key': [1, 2], 'int': 1})
+    db.insert({'key': {'x': 1}, 'int': 1})
+
+    with pytest.raises(ValueError):
+        db.insert({'key': [1, 2], 'int': 1})
+    with pytest.raises(ValueError):
+        db.insert({'key': {'x': 1}, 'int': 1})
+
+    assert db.upsert({'key': [1, 2], 'int': 5}) == [4]
+    assert db.upsert({'int': 6}, where('key') == [1, 2]) == [4]
+    assert db.get(doc_id=4)['int'] == 6
+
+    db.remove(doc_ids=[4])
+    db.insert({'key': [1, 2], 'int': 1})
+
+
+def test_unique_remove(db_unique):
+    db = db_unique
+
+    db.remove(where('key') == 'a')
+    db.remove(doc_ids=[2])
+
+    assert db._unique_index['key'] == {'c': 3}
+    db.insert({'key': 'a', 'int': 1})
+
+    db.truncate()
+    assert db._unique_index['key'] == {}
+
+
+def test_unique_upsert(db_unique):
+    db = db_unique
+
+    assert db.upsert({'key': 'a', 'int': 5}) == [1]
+    assert db.upsert({'key': 'b', 'int': 6}, where('key') == 'b') == [2]
+    assert db.upsert({'key': 'd', 'int': 7}) == [4]
+    assert db.upsert({'int': 8}, where('key') == 'e') == [5]
+
+    assert db.get(doc_id=1)['int'] == 5
+    assert db.get(doc_id=2)['int'] == 6
+    assert db.count(where('key') == 'd') == 1
+    assert len(db) == 5
+
+    # Queries that can't use the index fall back to a search
+    assert db.upsert({'int': 9}, where('int') == 1) == [3]
+
+
+def test_range_index(db_index):
+    db = db_index
+
+    db.truncate()
+    db.insert_multiple({'int': i} for i in range(10))
+
+    assert len(db.search(where('int') < 3)) == 3
+    assert len(db.search(where('int') <= 3)) == 4
+    assert len(db.search(where('int') > 7)) == 2
+    assert len(db.search(where('int') >= 7)) == 3
+    assert len(db.search(where('int') != 5)) == 9
+    assert len(db.search((where('int') >= 2) & (where('int') < 5))) == 3
+    assert len(db.search(~(where('int') == 1))) == 9
+
+
+def test_range_cache_subsumption(db_index):
+    db = db_index
+
+    db.truncate()
+    db.insert_multiple({'int': i, 'ts': i * 10} for i in range(10))
+
+    records = []
+    db.add_profile_hook(records.append)
+
+    def plan(query):
+        count = db.count(query)
+        return (records[-1]['plan'], records[-1]['examined'], count)
+
+    assert plan(where('ts') >= 50) == ('scan', 10, 5)
+
+    # Answered from the cached superset
+    assert plan(where('ts') >= 60) == ('subsume', 5, 4)
+    assert plan((where('ts') >= 60) & (where('ts') < 80)) == ('subsume', 4, 2)
+    assert plan(where('ts') == 90) == ('subsume', 4, 1)
+
+    # Not covered by the cache
+    assert plan(where('ts') >= 40) == ('scan', 10, 6)
+    assert plan(where('ts') > 0) == ('scan', 10, 9)
+
+
+def test_range_cache_prefers_index(db_index):
+    db = db_index
+
+    db.truncate()
+    db.insert_multiple({'int': i} for i in range(100))
+
+    records = []
+    db.add_profile_hook(records.append)
+
+    assert db.count(where('int') >= 0) == 100
+    assert db.count(where('int') == 5) == 1
+    assert (records[-1]['plan'], records[-1]['examined']) == ('index', 1)
+
+
+def test_range_cache_unordered(db_index):
+    db = db_index
+
+    db.truncate()
+    db.insert_multiple({'int': 1, 's': frozenset(s)} for s in [(), (1,), (1, 2), (2,)])
+
+    assert db.count(where('s') <= frozenset({1})) == 2
+    assert db.count(where('s') >= frozenset({1})) == 2
+
+    # Sets are only partially ordered, so the cached ranges can't be merged
+    assert db.get_covering_queries(where('s') >= frozenset()) is None
+    assert db.count(where('s') >= frozenset()) == 4
+
+
+def test_range_cache_merge(db_index):
+    db = db_index
+
+    db.truncate()
+    db.insert_multiple({'int': i, 'ts': i * 10} for i in range(10))
+
+    assert db.count(where('ts') < 30) == 3
+    assert db.count((where('ts') >= 30) & (where('ts') <= 60)) == 4
+    assert db.count(where('ts') > 60) == 3
+
+    low = where('ts') < 30
+    high = where('ts') > 60
+    query = (where('ts') > 10) & (where('ts') < 80)
+    assert db.get_covering_queries(query) == [low, (where('ts') >= 30) & (where('ts') <= 60), high]
+    assert db.count(query) == 6
+
+    # A gap between the cached intervals can't be merged
+    db.remove(where('ts') == 90)
+    db.clear_cache()
+    assert db.count(where('ts') < 30) == 3
+    assert db.count(where('ts') > 30) == 5
+    assert db.get_covering_queries(where('ts') >= 0) is None
+    assert db.count(where('ts') >= 0) == 9
+
+
+def test_callable_query(db_index):
+    db = db_index
+
+    def is_b(doc):
+        return doc['char'] == 'b'
+
+    assert db.get_index_query(is_b, ['int']) is None
+    assert db.get_covering_queries(is_b) is None
+    assert db.search(is_b) == [{'int': 1, 'yar': 5, 'char': 'b'}]
+    assert db.count(is_b) == 1
+
+
+def test_profile_hooks(db_index):
+    db = db_index
+
+    records = []
+    db.add_profile_hook(records.append)
+
+    db.search(where('int') == 1)
+    db.search(where('int') == 1)
+    db.search(where('char') == 'a')
+    db.insert({'int': 2})
+    db.update({'int': 3}, doc_ids=[4])
+    db.remove(where('int') == 3)
+
+    db.remove_profile_hook(records.append)
+    db.get(doc_id=1)
+
+    ops = [(r['operation'], r['plan'], r['examined'], r['returned']) for r in records]
+    assert ops == [
+        ('search', 'index', 3, 3),
+        ('search', 'cache', 3, 3),
+        ('search', 'scan', 3, 1),
+        ('_update_table', None, None, None),
+        ('insert', None, None, 1),
+        ('_update_table', None, None, None),
+        ('update', 'id', 1, 1),
+        ('_update_table', None, None, None),
+        ('remove', 'scan', 4, 1),
+    ]
+    assert records[0]['query_hash'] == hashlib.sha1(b"('==', ('int',), 1)").hexdigest()
+    assert all(r['duration'] >= 0 for r in records)
+
+    # Memory storage has no byte counts
+    assert records[4]['read_bytes'] is None
+    assert records[4]['write_bytes'] is None
+
+
+def test_profile_query_hash(db_index):
+    db = db_index
+
+    records = []
+    db.add_profile_hook(records.append)
+
+    # The digest doesn't depend on the order of set members, which changes
+    # from process to process
+    db.search((where('yar') == 5) & (where('char') == 'a'))
+    expected = "('and', {('==', ('char',), 'a'), ('==', ('yar',), 5)})"
+    assert records[0]['query_hash'] == hashlib.sha1(expected.encode()).hexdigest()
+
+    # Functions in a query are named instead of using their address
+    db.search(where('char').test(str.isalpha))
+    db.search(where('char').test(str.isalpha))
+    assert records[1]['query_hash'] is not None
+    assert records[1]['query_hash'] == records[2]['query_hash']
+
+    # Plain functions have no hash to digest
+    db.search(lambda doc: doc['char'] == 'a')
+    assert records[3]['query'] is not None
+    assert records[3]['query_hash'] is None
+
+
+def test_profile_storage_bytes(tmpdir):
+    TinyDB.table_class = IndexableTable
+    TinyDB.table_class.default_index_fields = ['int']
+
+    db_ = TinyDB(str(tmpdir.join('db.json')))
+    table = db_.table('_default')
+
+    records = []
+    table.add_profile_hook(records.append)
+    table.insert({'int': 1})
+    db_.close()
+
+    update = records[0]
+    assert update['operation'] == '_update_table'
+    # The written data is read back once
+    assert update['write_bytes'] == len(tmpdir.join('db.json').read())
+    assert update['read_bytes'] == update['write_bytes']
+    assert records[1]['write_bytes'] == update['write_bytes']
+
+
+def test_json_round_trip(tmpdir):
+    TinyDB.table_class = IndexableTable
+    TinyDB.table_class.default_index_fields = ['int']
+
+    db_ = TinyDB(str(tmpdir.join('db.json')))
+    table = db_.table('_default')
+
+    table.insert({'int': 1, 'a': (1, 2), 'd': {1: 'x'}})
+    table.insert_multiple([{'int': 2, 'a': (3, 4)}])
+
+    # Queries see the documents as the storage holds them
+    assert len(table.search(where('a') == [1, 2])) == 1
+    assert len(table.search(where('d')['1'] == 'x')) == 1
+    assert table.get(doc_id=1)['a'] == [1, 2]
+
+    table.update({'a': (5, 6)}, where('int') == 2)
+    assert table.search(where('a') == [5, 6]) == [{'int': 2, 'a': [5, 6]}]
+
+    db_.close()
+
+
+def test_outside_writes(tmpdir):
+    TinyDB.table_class = IndexableTable
+    TinyDB.table_class.default_index_fields = ['int']
+    path = str(tmpdir.join('db.json'))
+
+    db_1 = TinyDB(path)
+    table_1 = db_1.table('_default')
+    table_1.insert({'int': 1, 'char': 'a'})
+    assert len(table_1.search(where('char') == 'a')) == 1
+
+    db_2 = TinyDB(path)
+    db_2.table('_default').insert({'int': 2, 'char': 'a'})
+
+    # Reading the table picks up the other instance's write
+    assert len(table_1) == 2
+    assert len(table_1.search(where('char') == 'a')) == 2
+    assert len(table_1.search(where('int') == 2)) == 1
+
+    db_1.close()
+    db_2.close()
+
+
+def test_slow_query_log(db_index):
+    db = db_index
+
+    assert len(db.slow_query_log) == 0
+
+    db.slow_query_threshold = 0
+    db.search(where('int') == 1)
+    db.insert({'int': 2})
+
+    # Nested operations aren't logged on their own
+    assert [r['operation'] for r in db.slow_query_log] == ['search', 'insert']
+
+    db.slow_query_threshold = 60
+    db.search(where('int') == 2)
+
+    assert len(db.slow_query_log) == 2
+
+
+def test_profile_get(db_index):
+    db = db_index
+
+    records = []
+    db.add_profile_hook(records.append)
+
+    assert db.get(where('char') == 'b')['char'] == 'b'
+    assert db.get(where('char') == 'd') is None
+    db.get(doc_id=1)
+
+    ops = [(r['plan'], r['examined'], r['returned']) for r in records]
+    assert ops == [('scan', 2, 1), ('scan', 3, 0), ('id', 1, 1)]
+
+
+def test_profile_hook_errors(db_unique):
+    db = db_unique
+
+    def broken_hook(record):
+        raise RuntimeError('broken')
+
+    db.add_profile_hook(broken_hook)
+
+    # The insert succeeded, so the hook's error isn't raised
+    db.insert({'key': 'd', 'int': 1})
+    assert len(db) == 4
+
+    # The operation's own error isn't hidden by the hook
+    with pytest.raises(ValueError):
+        db.insert({'key': 'd', 'int': 1})
+
+
+def test_profile_middleware_bytes(tmpdir):
+    TinyDB.table_class = IndexableTable
+    TinyDB.table_class.default_index_fields = ['int']
+
+    db_ = TinyDB(str(tmpdir.join('db.json')), storage=CachingMiddleware(JSONStorage))
+    table = db_.table('_default')
+
+    records = []
+    table.add_profile_hook(records.append)
+    table.insert({'int': 1})
+    table.insert({'int': 2})
+
+    assert all(r['read_bytes'] is None for r in records)
+    assert all(r['write_bytes'] is None for r in records)
+    db_.close()